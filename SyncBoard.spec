@@ -5,8 +5,12 @@ a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[],
-    hiddenimports=[],
+    datas=[('index.html', '.')],
+    hiddenimports=[
+        'uvicorn.loops.uvloop',
+        'uvicorn.protocols.http.httptools_impl',
+        'uvicorn.protocols.websockets.websockets_impl',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
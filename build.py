@@ -36,6 +36,11 @@ def build_executable():
         "-n", exe_name,
         "--windowed",  # 無控制台視窗
         "--clean",  # 清理暫存
+        "--add-data", f"index.html{os.pathsep}.",  # 網頁內容
+        # uvicorn 以字串動態載入事件迴圈與協定實作，需明確列出
+        "--hidden-import", "uvicorn.loops.uvloop",
+        "--hidden-import", "uvicorn.protocols.http.httptools_impl",
+        "--hidden-import", "uvicorn.protocols.websockets.websockets_impl",
         "main.py"
     ]
     
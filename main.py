@@ -1,309 +1,533 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import functools
+import hashlib
+import heapq
+import itertools
+import logging
 import os
+import platform
 import socket
 import tempfile
 import time
 import uuid
 import shutil
+import zlib
+from collections import deque
+from contextlib import asynccontextmanager
 from io import BytesIO
-from typing import Optional, Set, List, Dict
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Deque, Iterator, Optional, List, Dict, Tuple, Union
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, Response, FileResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException
+from fastapi.responses import JSONResponse, Response, FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import orjson
 import uvicorn
 import qrcode
 
 
+logger = logging.getLogger("syncboard")
+
+# 保留的訊息數量上限
+MAX_HISTORY = 1000
+# 已刪除訊息累積超過此數量時壓縮歷史紀錄
+COMPACT_THRESHOLD = 100
+# 上傳時每次讀取的區塊大小
+UPLOAD_CHUNK_SIZE = 1 << 20
+# 同時處理的上傳數量上限，超過時回應 503
+MAX_CONCURRENT_UPLOADS = 4
+# 上傳請求本體大小上限
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024
+# 啟用 --spill-to-disk 時，超過此大小的檔案改存到暫存檔，不佔用 Python heap
+MEMORY_FILE_LIMIT = 8 * 1024 * 1024
+# 暫存目錄名稱前綴
+SPOOL_PREFIX = "syncboard-"
+# 文字類檔案在記憶體中以 gzip 壓縮保存
+COMPRESSIBLE_EXTENSIONS = {
+    ".txt", ".csv", ".tsv", ".json", ".xml", ".html", ".htm", ".css", ".js",
+    ".md", ".log", ".yaml", ".yml", ".svg", ".sql", ".py",
+}
+# 小於此大小的檔案不壓縮
+COMPRESS_MIN_SIZE = 4 * 1024
+# zlib 的 wbits 設為 16 + MAX_WBITS 代表 gzip 格式，可直接作為 Content-Encoding: gzip 送出
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# 上傳讀取緩衝區的重複使用數量上限
+BUFFER_POOL_SIZE = 32
+# 記憶體檔案保留秒數
+FILE_TTL = 3600
+# 背景清理到期檔案的間隔秒數
+CLEANUP_INTERVAL = 60
+# 下載時每次送出的區塊大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# 上傳用的讀取緩衝區，重複使用以減少大區塊配置
+buffer_pool: List[bytearray] = []
+
+
+def acquire_buffer() -> bytearray:
+    if buffer_pool:
+        return buffer_pool.pop()
+    return bytearray(UPLOAD_CHUNK_SIZE)
+
+
+def release_buffer(buf: bytearray) -> None:
+    if len(buffer_pool) < BUFFER_POOL_SIZE:
+        buffer_pool.append(buf)
+
+
+def read_into(src: BinaryIO, buf: bytearray) -> int:
+    # SpooledTemporaryFile 在 Python 3.11 之前沒有 readinto，改用 read 再複製進緩衝區
+    readinto = getattr(src, "readinto", None)
+    if readinto is not None:
+        return readinto(buf)
+    data = src.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+def remove_stale_spool_dirs() -> None:
+    # 程式異常結束時不會刪除暫存目錄；超過 FILE_TTL 沒有新增檔案的目錄，裡面的檔案都已過期
+    cutoff = time.time() - FILE_TTL
+    try:
+        entries = list(os.scandir(tempfile.gettempdir()))
+    except OSError:
+        return
+    for entry in entries:
+        if not entry.name.startswith(SPOOL_PREFIX):
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def copy_to_temp(src: BinaryIO, directory: str) -> str:
+    # 目錄可能已被其他程序當成過期目錄清掉
+    os.makedirs(directory, exist_ok=True)
+    dst = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    try:
+        with dst:
+            shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+    except BaseException:
+        os.unlink(dst.name)
+        raise
+    return dst.name
+
+
+def gzip_compress(data: bytearray) -> bytes:
+    c = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+    return c.compress(data) + c.flush()
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    # 依 q 值判斷，gzip;q=0 代表拒絕；明確列出的 gzip 優先於 *
+    qvalues: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.strip().lower()] = q
+    q = qvalues.get("gzip", qvalues.get("*", 0.0))
+    return q > 0
+
+
+async def iter_chunks(data: Union[bytes, bytearray], size: int = DOWNLOAD_CHUNK_SIZE) -> AsyncIterator[memoryview]:
+    # 以 memoryview 切片逐段送出，不複製底層資料；
+    # 使用非同步產生器，避免 StreamingResponse 每段都切換到執行緒池
+    view = memoryview(data)
+    for i in range(0, len(view), size):
+        yield view[i:i + size]
+
+
+async def iter_decompressed(data: bytes, size: int = DOWNLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    # 給不接受 gzip 的用戶端，邊解壓縮邊送出，不還原出完整檔案；
+    # 以 max_length 限制每段輸出，高壓縮率的檔案也不會一次解出大量資料
+    d = zlib.decompressobj(GZIP_WBITS)
+    view = memoryview(data)
+    for i in range(0, len(view), size):
+        pending: Union[bytes, memoryview] = view[i:i + size]
+        while pending:
+            out = d.decompress(pending, size)
+            if out:
+                yield out
+            pending = d.unconsumed_tail
+    tail = d.flush()
+    if tail:
+        yield tail
+
+
+class UploadLimitMiddleware:
+    # FastAPI 會先收完並暫存整個 multipart 本體才呼叫 handler，
+    # 所以上傳大小與同時上傳數量要在這裡、接收本體的當下就限制
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] != "/upload":
+            await self.app(scope, receive, send)
+            return
+
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > MAX_UPLOAD_BYTES:
+            await JSONResponse({"detail": "File too large"}, status_code=413)(scope, receive, send)
+            return
+        if self.slots.locked():
+            await JSONResponse({"detail": "Too many uploads in progress"}, status_code=503)(scope, receive, send)
+            return
+
+        received = 0
+
+        # 沒有 Content-Length（chunked）時邊收邊計算
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+            return message
+
+        async with self.slots:
+            await self.app(scope, limited_receive, send)
+
+
+class FileMeta:
+    __slots__ = ("filename", "size", "timestamp", "gzip")
+
+    def __init__(self, filename: str, size: int, timestamp: float, gzip: bool = False) -> None:
+        self.filename = filename
+        self.size = size
+        self.timestamp = timestamp
+        self.gzip = gzip
+
+
+class Peer:
+    __slots__ = ("ws", "prev", "next")
+
+    def __init__(self, ws: Optional[WebSocket] = None) -> None:
+        self.ws = ws
+        self.prev: Optional[Peer] = self
+        self.next: Peer = self
+
+
+class PeerList:
+    # 以哨兵節點串起的雙向鏈結串列：加入與移除皆為 O(1)，廣播時不需複製整個集合。
+    # 移除的節點保留 next 指標並把 prev 設為 None，正在走訪的廣播仍能繼續往下走。
+    def __init__(self) -> None:
+        self.head = Peer()
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, ws: WebSocket) -> Peer:
+        node = Peer(ws)
+        node.prev = self.head
+        node.next = self.head.next
+        self.head.next.prev = node
+        self.head.next = node
+        self.count += 1
+        return node
+
+    def remove(self, node: Peer) -> None:
+        if node.prev is None:
+            return
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        node.prev = None
+        # 移除後不再持有 WebSocket，避免被殘留的節點參照而無法釋放
+        node.ws = None
+        self.count -= 1
+
+    def __iter__(self) -> Iterator[Peer]:
+        # 先取得下一個節點再交出目前節點，呼叫端 await 期間移除節點也安全
+        node = self.head.next
+        while node is not self.head:
+            nxt = node.next
+            if node.prev is not None:
+                yield node
+            node = nxt
+
+
+# 本機 IP 在程序執行期間視為不變，只查詢一次
+@functools.lru_cache(maxsize=1)
 def get_local_ip() -> str:
+    # UDP connect 不會送出封包，只用來取得對外路由所使用的本機位址
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setblocking(False)
     try:
         s.connect(("8.8.8.8", 80))
         return s.getsockname()[0]
-    except Exception:
+    except OSError:
         return "127.0.0.1"
     finally:
         s.close()
 
 
-def build_app() -> FastAPI:
-    app = FastAPI(title="SyncBoard Browser")
-    sockets: Set[WebSocket] = set()
-    messages: List[Dict] = []  # {id, content, ts, sender, type}
+# 頁面內容固定，匯入時讀入並計算 ETag
+INDEX_BYTES = (Path(__file__).parent / "index.html").read_bytes()
+INDEX_ETAG = '"' + hashlib.blake2b(INDEX_BYTES, digest_size=8).hexdigest() + '"'
+
+
+def make_qr_png(url: str) -> bytes:
+    img = qrcode.make(url)
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def build_app(port: int = 56321, spill_to_disk: bool = False) -> FastAPI:
+    @asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+        stop = asyncio.Event()
+
+        async def cleaner() -> None:
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=CLEANUP_INTERVAL)
+                except asyncio.TimeoutError:
+                    cleanup_old_files()
+                    # 連線數只增不減代表有連線沒被移除
+                    logger.debug("active websocket peers: %d", len(peers))
+
+        if spool_dir is not None:
+            remove_stale_spool_dirs()
+        # 保留 task 的強參照，避免被 GC 回收
+        app.state.cleaner_task = asyncio.create_task(cleaner())
+        try:
+            yield
+        finally:
+            stop.set()
+            await app.state.cleaner_task
+            if spool_dir is not None:
+                shutil.rmtree(spool_dir, ignore_errors=True)
+
+    app = FastAPI(title="SyncBoard Browser", lifespan=lifespan)
+    app.add_middleware(UploadLimitMiddleware)
+    peers = PeerList()
+    messages: Deque[Dict] = deque(maxlen=MAX_HISTORY)  # {id, content, ts, sender, type, deleted?}
+    msg_by_id: Dict[int, Dict] = {}  # {id: item}，只包含未刪除的訊息，順序與 messages 相同
+    next_id = itertools.count(1)
+    tombstones = 0
+    # 已編碼的 history 訊框，歷史紀錄有變動時才重新產生
+    history_payload: Optional[bytes] = None
+
+    def get_history_payload() -> bytes:
+        nonlocal history_payload
+        if history_payload is None:
+            history_payload = orjson.dumps({"type": "history", "items": list(msg_by_id.values())})
+        return history_payload
+
+    def add_message(item: Dict) -> None:
+        nonlocal tombstones, history_payload
+        history_payload = None
+        # deque 滿了會自動丟掉最舊的一筆，先同步索引
+        if len(messages) == messages.maxlen:
+            oldest = messages[0]
+            if oldest.get("deleted"):
+                tombstones -= 1
+            else:
+                msg_by_id.pop(oldest["id"], None)
+        messages.append(item)
+        msg_by_id[item["id"]] = item
+
+    # 刪除只標記 deleted，累積到一定數量才重建 deque
+    def delete_message(msg_id: int) -> None:
+        nonlocal tombstones, history_payload
+        item = msg_by_id.pop(msg_id, None)
+        if item is None:
+            return
+        history_payload = None
+        item["deleted"] = True
+        tombstones += 1
+        if tombstones > COMPACT_THRESHOLD:
+            messages.clear()
+            messages.extend(msg_by_id.values())
+            tombstones = 0
+
+    def clear_messages() -> None:
+        nonlocal tombstones, history_payload
+        history_payload = None
+        messages.clear()
+        msg_by_id.clear()
+        tombstones = 0
     
-    # 檔案暫存在記憶體中，不下載就消失
-    file_cache: Dict[str, bytes] = {}  # {file_id: file_content}
-    file_metadata: Dict[str, Dict] = {}  # {file_id: {filename, size, timestamp}}
+    # 檔案暫存在記憶體中，不下載就消失；啟用 spill_to_disk 時大檔案放在暫存目錄，關閉服務時一併刪除
+    file_cache: Dict[str, Union[bytes, bytearray, str]] = {}  # {file_id: 檔案內容或暫存檔路徑}
+    file_metadata: Dict[str, FileMeta] = {}
+    expiry_heap: List[Tuple[float, str]] = []  # [(expiry_ts, file_id)]，依到期時間排序
+    spool_dir = tempfile.mkdtemp(prefix=SPOOL_PREFIX) if spill_to_disk else None
+
+    def discard_file(file_id: str) -> None:
+        content = file_cache.pop(file_id, None)
+        file_metadata.pop(file_id, None)
+        if isinstance(content, str):
+            try:
+                os.unlink(content)
+            except OSError:
+                pass
     
-    # 清理超過 1 小時的記憶體檔案
+    # 清理超過 1 小時的記憶體檔案：只從堆積頂端取出已到期的項目，不掃描整個快取
     def cleanup_old_files():
-        try:
-            current_time = time.time()
-            expired_files = []
-            for file_id, metadata in file_metadata.items():
-                if current_time - metadata['timestamp'] > 3600:  # 1 小時
-                    expired_files.append(file_id)
-            
-            for file_id in expired_files:
-                file_cache.pop(file_id, None)
-                file_metadata.pop(file_id, None)
-        except Exception:
-            pass
+        current_time = time.time()
+        while expiry_heap and expiry_heap[0][0] <= current_time:
+            _, file_id = heapq.heappop(expiry_heap)
+            discard_file(file_id)
 
     @app.get("/")
-    async def index() -> HTMLResponse:
-        html = """
-<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8" />
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <title>SyncBoard</title>
-  <style>
-    :root { --bg: #0b0f1a; --panel: #111827; --card: #0f172a; --text: #e5e7eb; --muted: #94a3b8; --accent: #22d3ee; }
-    html, body { height: 100%; margin: 0; }
-    body { background: linear-gradient(135deg, #0b0f1a, #0a0f2c); color: var(--text); font-family: ui-sans-serif, system-ui, -apple-system, "Segoe UI", Roboto, "Helvetica Neue", Arial; }
-    .container { max-width: 860px; margin: 0 auto; padding: 12px; display: flex; flex-direction: column; height: 100vh; box-sizing: border-box; }
-    .header { display: flex; align-items: center; justify-content: space-between; padding: 8px 0 12px 0; flex-wrap: wrap; gap: 8px; }
-    .brand { font-weight: 700; letter-spacing: 0.5px; font-size: 18px; }
-    .brand .accent { color: var(--accent); }
-    .chat { flex: 1; background: rgba(255,255,255,0.02); border: 1px solid rgba(255,255,255,0.06); border-radius: 12px; padding: 12px; overflow: auto; box-shadow: inset 0 0 0 1px rgba(255,255,255,0.02); min-height: 0; margin-bottom: 12px; }
-    .msg { background: var(--card); border: 1px solid rgba(255,255,255,0.08); border-radius: 10px; padding: 10px 12px; margin: 8px 0; display: flex; flex-direction: column; gap: 8px; }
-    .msg .meta { font-size: 12px; color: var(--muted); display: flex; gap: 8px; }
-    .msg .content { white-space: pre-wrap; word-wrap: break-word; }
-    .msg .actions { display: flex; gap: 6px; flex-wrap: wrap; }
-    .msg.file { border-left: 3px solid var(--accent); }
-    .msg .file-info { display: flex; align-items: center; gap: 8px; margin: 4px 0; flex-wrap: wrap; }
-    .msg .file-icon { width: 16px; height: 16px; flex-shrink: 0; }
-    .msg .file-link { color: var(--accent); text-decoration: none; word-break: break-all; }
-    .msg .file-link:hover { text-decoration: underline; }
-    .msg .image-preview { max-width: 100%; max-height: 200px; border-radius: 8px; margin: 8px 0; cursor: pointer; }
-    .msg .image-preview:hover { opacity: 0.8; }
-    .input { display: flex; flex-direction: column; gap: 10px; }
-    .input-row { display: flex; gap: 10px; align-items: flex-end; }
-    .input-controls { display: flex; flex-direction: column; gap: 8px; min-width: 80px; }
-    textarea { resize: vertical; min-height: 80px; max-height: 40vh; background: var(--panel); color: var(--text); border: 1px solid rgba(255,255,255,0.08); border-radius: 10px; padding: 10px 12px; font-size: 14px; outline: none; box-shadow: 0 0 0 1px rgba(34,211,238,0); transition: box-shadow .2s ease; flex: 1; }
-    textarea:focus { box-shadow: 0 0 0 1px rgba(34,211,238,.35); }
-    .controls { display: flex; gap: 8px; align-items: center; flex-wrap: wrap; }
-    .btn { background: linear-gradient(135deg, #06b6d4, #22d3ee); color: #001018; border: none; padding: 8px 12px; border-radius: 8px; font-weight: 600; cursor: pointer; font-size: 14px; white-space: nowrap; }
-    .btn.secondary { background: transparent; color: var(--text); border: 1px solid rgba(255,255,255,0.12); }
-    .hint { color: var(--muted); font-size: 11px; margin-top: 6px; }
-    .name { background: var(--panel); color: var(--text); border: 1px solid rgba(255,255,255,0.08); border-radius: 8px; padding: 8px 10px; width: 120px; font-size: 14px; }
-    
-    @media (max-width: 768px) {
-      .container { padding: 8px; }
-      .header { flex-direction: column; align-items: stretch; }
-      .controls { justify-content: space-between; }
-      .name { width: 100%; }
-      .input-row { flex-direction: row; align-items: flex-end; }
-      .input-controls { flex-direction: column; min-width: 80px; }
-      .btn { padding: 8px 10px; font-size: 12px; }
-      .msg .actions { justify-content: flex-start; }
-      .msg .file-info { flex-direction: column; align-items: flex-start; gap: 4px; }
-      .msg .image-preview { max-width: 100%; max-height: 150px; }
-      textarea { min-height: 60px; }
-    }
-  </style>
-  </head>
-  <body>
-    <div class="container">
-      <div class="header">
-        <div class="brand">Sync<span class="accent">Board</span></div>
-        <div class="controls">
-          <input id="name" class="name" placeholder="Your name" />
-          <button id="copyLink" class="btn secondary">📋 Copy Link</button>
-          <a class="btn secondary" href="/qr" target="_blank">QR</a>
-        </div>
-      </div>
-      <div id="chat" class="chat"></div>
-      <div class="input">
-        <div class="input-row">
-          <textarea id="msg" placeholder="Type and press Send..."></textarea>
-          <div class="input-controls">
-            <button id="send" class="btn">Send</button>
-            <button id="upload" class="btn secondary">📎 File</button>
-            <button id="clear" class="btn secondary">Clear</button>
-          </div>
-        </div>
-      </div>
-      <div class="hint">Tip: On mobile HTTP, browsers may require a tap to copy.</div>
-    </div>
-    <script>
-      const elChat = document.getElementById('chat');
-      const elMsg = document.getElementById('msg');
-      const elName = document.getElementById('name');
-      const ws = new WebSocket((location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + '/ws');
-
-      const fmt = (ts) => new Date(ts * 1000).toLocaleString();
-      const scrollBottom = () => { elChat.scrollTop = elChat.scrollHeight; };
-
-      function renderMessage(m) {
-        const card = document.createElement('div');
-        card.className = m.type === 'file' ? 'msg file' : 'msg';
-        card.setAttribute('data-id', m.id);
-        const content = document.createElement('div');
-        content.className = 'content';
-        if (m.type === 'file') {
-          const fileInfo = document.createElement('div');
-          fileInfo.className = 'file-info';
-          const isImage = /\.(jpg|jpeg|png|gif|webp|bmp)$/i.test(m.filename);
-          if (isImage) {
-            const img = document.createElement('img');
-            img.className = 'image-preview';
-            img.src = `/files/${m.file_id}`;
-            img.alt = m.filename;
-            img.onclick = () => window.open(`/files/${m.file_id}`, '_blank');
-            content.appendChild(img);
-          }
-          fileInfo.innerHTML = `<span class="file-icon">${isImage ? '🖼️' : '📎'}</span><a href="/files/${m.file_id}" class="file-link" target="_blank">${m.filename}</a> <span style="color: var(--muted);">(${m.size} bytes)</span>`;
-          content.appendChild(fileInfo);
-        } else {
-          content.textContent = m.content || '';
-        }
-        const actions = document.createElement('div');
-        actions.className = 'actions';
-        if (m.type !== 'file') {
-          const copy = document.createElement('button');
-          copy.textContent = 'Copy';
-          copy.className = 'btn secondary';
-          copy.onclick = async () => { try { await navigator.clipboard.writeText(m.content || ''); } catch(e){} };
-          actions.appendChild(copy);
-        } else {
-          const download = document.createElement('button');
-          download.textContent = 'Download';
-          download.className = 'btn secondary';
-          download.onclick = () => { window.open(`/files/${m.file_id}`, '_blank'); };
-          actions.appendChild(download);
-        }
-        const del = document.createElement('button');
-        del.textContent = 'Delete';
-        del.className = 'btn secondary';
-        del.onclick = () => { ws.send(JSON.stringify({ type: 'delete', id: m.id })); };
-        actions.appendChild(del);
-        const meta = document.createElement('div');
-        meta.className = 'meta';
-        meta.textContent = `${m.sender || 'Anon'} • ${fmt(m.ts)}`;
-        card.appendChild(content);
-        card.appendChild(actions);
-        card.appendChild(meta);
-        elChat.appendChild(card);
-      }
-
-      function renderHistory(items){ elChat.innerHTML=''; (items||[]).forEach(renderMessage); scrollBottom(); }
-
-      ws.onmessage = (e) => {
-        try {
-          const data = JSON.parse(e.data);
-          if (data.type === 'history') { renderHistory(data.items); return; }
-          if (data.type === 'message') { renderMessage(data.item); scrollBottom(); return; }
-          if (data.type === 'delete') { 
-            const el = document.querySelector(`[data-id="${data.id}"]`);
-            if (el) el.remove();
-            return;
-          }
-          if (data.type === 'clear') { renderHistory([]); return; }
-        } catch {}
-      };
-
-      document.getElementById('send').onclick = () => {
-        const sender = elName.value.trim() || 'Anon';
-        const content = elMsg.value;
-        ws.send(JSON.stringify({ type: 'message', sender, content, msg_type: 'text' }));
-        elMsg.value = '';
-      };
-      document.getElementById('upload').onclick = async () => {
-        const input = document.createElement('input');
-        input.type = 'file';
-        input.onchange = async (e) => {
-          const file = e.target.files[0];
-          if (!file) return;
-          const formData = new FormData();
-          formData.append('file', file);
-          try {
-            const res = await fetch('/upload', { method: 'POST', body: formData });
-            const data = await res.json();
-            const sender = elName.value.trim() || 'Anon';
-            ws.send(JSON.stringify({ type: 'message', sender, msg_type: 'file', file_id: data.file_id, filename: data.filename, size: data.size }));
-          } catch (e) { console.error('Upload failed:', e); }
-        };
-        input.click();
-      };
-      document.getElementById('clear').onclick = () => {
-        ws.send(JSON.stringify({ type: 'clear' }));
-      };
-      document.getElementById('copyLink').onclick = async () => {
-        const url = window.location.href;
-        try {
-          await navigator.clipboard.writeText(url);
-          const btn = document.getElementById('copyLink');
-          const originalText = btn.textContent;
-          btn.textContent = '✅ Copied!';
-          setTimeout(() => { btn.textContent = originalText; }, 2000);
-        } catch (e) {
-          // 備援方案：顯示網址讓使用者手動複製
-          prompt('Copy this link:', url);
-        }
-      };
-    </script>
-  </body>
-  </html>
-        """
-        return HTMLResponse(content=html)
+    async def index(request: Request) -> Response:
+        # 接受多個 ETag、弱驗證碼（W/）與 *
+        tags = set()
+        for tag in request.headers.get("if-none-match", "").split(","):
+            tag = tag.strip()
+            tags.add(tag[2:] if tag.startswith("W/") else tag)
+        if INDEX_ETAG in tags or "*" in tags:
+            return Response(status_code=304, headers={"ETag": INDEX_ETAG})
+        return Response(
+            content=INDEX_BYTES,
+            media_type="text/html; charset=utf-8",
+            headers={"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=60"}
+        )
+
+    # QR 碼內容只取決於本機 IP 與埠號，啟動時產生一次即可
+    qr_png = make_qr_png(f"http://{get_local_ip()}:{port}")
 
     @app.get("/qr")
     async def qr() -> Response:
-        url = f"http://{get_local_ip()}:56321"
-        img = qrcode.make(url)
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        return Response(content=buf.getvalue(), media_type="image/png")
+        return Response(
+            content=qr_png,
+            media_type="image/png",
+            headers={"Cache-Control": "public, max-age=86400"}
+        )
 
     @app.post("/upload")
     async def upload_file(file: UploadFile = File(...)) -> dict:
         if not file.filename:
             raise HTTPException(status_code=400, detail="No filename")
         
+        # 大小與同時上傳數量已由 UploadLimitMiddleware 在接收本體時限制
         file_id = str(uuid.uuid4())
-        content = await file.read()
+        if spool_dir is not None and file.size is not None and file.size > MEMORY_FILE_LIMIT:
+            # 大檔案直接複製到暫存檔，下載時由 FileResponse 送出
+            content: Union[bytes, bytearray, str] = await run_in_threadpool(copy_to_temp, file.file, spool_dir)
+            size = file.size
+        else:
+            # 分段讀取到共用緩衝區，避免一次配置整個檔案大小的 bytes 並阻塞事件迴圈
+            content = bytearray()
+            buf = acquire_buffer()
+            view = memoryview(buf)
+            try:
+                while True:
+                    n = await run_in_threadpool(read_into, file.file, buf)
+                    if not n:
+                        break
+                    content += view[:n]
+            finally:
+                view.release()
+                release_buffer(buf)
+            size = len(content)
         
-        # 儲存到記憶體
-        file_cache[file_id] = content
-        file_metadata[file_id] = {
-            "filename": file.filename,
-            "size": len(content),
-            "timestamp": time.time()
-        }
+        compressed = False
+        ext = os.path.splitext(file.filename)[1].lower()
+        if isinstance(content, bytearray) and size >= COMPRESS_MIN_SIZE and ext in COMPRESSIBLE_EXTENSIONS:
+            gz = await run_in_threadpool(gzip_compress, content)
+            # 壓縮效果不明顯就保留原始內容
+            if len(gz) < 0.9 * size:
+                content = gz
+                compressed = True
         
-        # 清理舊檔案
-        cleanup_old_files()
+        # 儲存到快取
+        now = time.time()
+        file_cache[file_id] = content
+        file_metadata[file_id] = FileMeta(file.filename, size, now, compressed)
+        heapq.heappush(expiry_heap, (now + FILE_TTL, file_id))
         
-        return {"file_id": file_id, "filename": file.filename, "size": len(content)}
+        return {"file_id": file_id, "filename": file.filename, "size": size}
 
     @app.get("/files/{file_id}")
-    async def get_file(file_id: str) -> Response:
+    async def get_file(file_id: str, request: Request) -> Response:
         if file_id not in file_cache:
             raise HTTPException(status_code=404, detail="File not found or expired")
         
-        metadata = file_metadata.get(file_id, {})
-        filename = metadata.get("filename", "unknown")
+        metadata = file_metadata[file_id]
+        # 背景清理每分鐘才跑一次，這裡再確認一次是否已過期
+        if time.time() - metadata.timestamp > FILE_TTL:
+            discard_file(file_id)
+            raise HTTPException(status_code=404, detail="File not found or expired")
+        filename = metadata.filename
         content = file_cache[file_id]
         
-        return Response(
-            content=content,
+        if isinstance(content, str):
+            return FileResponse(content, media_type="application/octet-stream", filename=filename)
+        if metadata.gzip:
+            headers = {
+                "Content-Disposition": f"attachment; filename={filename}",
+                "Vary": "Accept-Encoding",
+            }
+            if accepts_gzip(request.headers.get("accept-encoding", "")):
+                headers["Content-Encoding"] = "gzip"
+                headers["Content-Length"] = str(len(content))
+                body = iter_chunks(content)
+            else:
+                headers["Content-Length"] = str(metadata.size)
+                body = iter_decompressed(content)
+            return StreamingResponse(body, media_type="application/octet-stream", headers=headers)
+        return StreamingResponse(
+            iter_chunks(content),
             media_type="application/octet-stream",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
+            headers={
+                "Content-Disposition": f"attachment; filename={filename}",
+                "Content-Length": str(len(content)),
+            }
         )
 
+    async def broadcast(data: Dict) -> None:
+        # 只序列化一次，再把同一份 bytes 送給所有連線
+        payload = orjson.dumps(data)
+        # 同時送出給所有連線，廣播延遲取決於最慢的一條而非全部加總
+        dead: List[WebSocket] = []
+
+        async def send(peer: Peer) -> None:
+            ws = peer.ws
+            # 排程後、執行前連線可能已自行移除
+            if ws is None:
+                return
+            try:
+                await ws.send_bytes(payload)
+            except Exception:
+                peers.remove(peer)
+                dead.append(ws)
+
+        await asyncio.gather(*(send(peer) for peer in peers))
+        # 送完所有連線後才關閉失效的連線，避免拖慢其他連線
+        for dead_ws in dead:
+            try:
+                await dead_ws.close()
+            except Exception:
+                pass
+
     @app.websocket("/ws")
     async def ws_endpoint(ws: WebSocket) -> None:
         await ws.accept()
-        sockets.add(ws)
+        peer = peers.add(ws)
         try:
             # send history on connect
-            await ws.send_json({"type": "history", "items": messages})
+            await ws.send_bytes(get_history_payload())
             while True:
-                data = await ws.receive_json()
+                data = orjson.loads(await ws.receive_text())
                 t = data.get("type")
                 if t == "message":
                     sender = (data.get("sender") or "Anon").strip() or "Anon"
@@ -312,51 +536,30 @@ def build_app() -> FastAPI:
                         content = (data.get("content") or "").rstrip()
                         if not content:
                             continue
-                        item = {"id": len(messages)+1, "content": content, "ts": time.time(), "sender": sender, "type": "text"}
+                        item = {"id": next(next_id), "content": content, "ts": time.time(), "sender": sender, "type": "text"}
                     elif msg_type == "file":
                         file_id = data.get("file_id")
                         filename = data.get("filename")
                         size = data.get("size")
                         if not file_id or not filename:
                             continue
-                        item = {"id": len(messages)+1, "file_id": file_id, "filename": filename, "size": size, "ts": time.time(), "sender": sender, "type": "file"}
-                    messages.append(item)
-                    for peer in list(sockets):
-                        try:
-                            await peer.send_json({"type": "message", "item": item})
-                        except Exception:
-                            try:
-                                await peer.close()
-                            except Exception:
-                                pass
-                            sockets.discard(peer)
+                        item = {"id": next(next_id), "file_id": file_id, "filename": filename, "size": size, "ts": time.time(), "sender": sender, "type": "file"}
+                    add_message(item)
+                    await broadcast({"type": "message", "item": item})
                 elif t == "delete":
                     msg_id = data.get("id")
-                    messages[:] = [m for m in messages if m.get("id") != msg_id]
-                    for peer in list(sockets):
-                        try:
-                            await peer.send_json({"type": "delete", "id": msg_id})
-                        except Exception:
-                            try:
-                                await peer.close()
-                            except Exception:
-                                pass
-                            sockets.discard(peer)
+                    # id 來自用戶端，非整數（含 bool）直接忽略
+                    if not isinstance(msg_id, int) or isinstance(msg_id, bool):
+                        continue
+                    delete_message(msg_id)
+                    await broadcast({"type": "delete", "id": msg_id})
                 elif t == "clear":
-                    messages.clear()
-                    for peer in list(sockets):
-                        try:
-                            await peer.send_json({"type": "clear"})
-                        except Exception:
-                            try:
-                                await peer.close()
-                            except Exception:
-                                pass
-                            sockets.discard(peer)
+                    clear_messages()
+                    await broadcast({"type": "clear"})
         except WebSocketDisconnect:
             pass
         finally:
-            sockets.discard(ws)
+            peers.remove(peer)
 
     return app
 
@@ -364,19 +567,37 @@ def build_app() -> FastAPI:
 def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
     p = argparse.ArgumentParser(description="SyncBoard Browser Server")
     p.add_argument("--port", type=int, default=56321)
+    p.add_argument("--spill-to-disk", action="store_true",
+                   help="大於 8 MiB 的檔案改存到系統暫存目錄，降低記憶體用量")
     return p.parse_args(argv)
 
 
 def main() -> None:
     args = parse_args()
-    app = build_app()
+    app = build_app(args.port, spill_to_disk=args.spill_to_disk)
     
-    print(f"🚀 即時傳輸模式：檔案暫存記憶體，不下載就消失")
+    if args.spill_to_disk:
+        print("🚀 即時傳輸模式：大於 8 MiB 的檔案暫存於系統暫存目錄，其餘暫存記憶體，1 小時後清除")
+    else:
+        print(f"🚀 即時傳輸模式：檔案暫存記憶體，不下載就消失")
     print(f"🌐 服務啟動: http://127.0.0.1:{args.port}")
     print(f"📱 手機連線: http://{get_local_ip()}:{args.port}")
     print(f"🔗 QR 碼: http://{get_local_ip()}:{args.port}/qr")
     
-    uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="info")
+    # 訊息與檔案都存在單一進程的記憶體中，因此維持單一 worker；
+    # uvloop 僅支援 POSIX，Windows 沿用 asyncio 預設事件迴圈
+    loop = "asyncio" if platform.system() == "Windows" else "uvloop"
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=args.port,
+        loop=loop,
+        http="httptools",
+        ws="websockets",
+        # 訊息多為小型 JSON，壓縮幾乎沒有效益，卻會替每條連線配置 zlib 狀態
+        ws_per_message_deflate=False,
+        log_level="info",
+    )
 
 
 if __name__ == "__main__":